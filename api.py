@@ -10,34 +10,57 @@ Contains the API endpoints for the Hangman game.
 import endpoints
 import logging
 
+from datetime import date, datetime
+
 from protorpc import remote, messages
 from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import User, UserStats, Game, Score, AggregationRun
+from models import LeaderboardBucket, LEADERBOARD_RETENTION_DAYS
+from models import MEMCACHE_MOVES_REMAINING, moves_remaining_message
 
-from models import User, UserForms
-from models import GuessForm, GuessForms
-from models import Game, GameForm, GameForms, NewGameForm, MakeMoveForm
-from models import Score, ScoreForms
-from models import StringMessage
+from forms import UserForms, UserStatsForm
+from forms import GuessForms, GuessHistoryForm
+from forms import GameForm, GameForms, GamePollForm, NewGameForm, MakeMoveForm
+from forms import DashboardForm, DashboardGameForm
+from forms import ScoreForms
+from forms import StringMessage
 
-from utils import get_by_urlsafe
+from utils import get_by_urlsafe, rate_limit
 
 
 USER_REQUEST = endpoints.ResourceContainer(
     user_name = messages.StringField(1),
     email = messages.StringField(2))
+DASHBOARD_REQUEST = endpoints.ResourceContainer(
+    user_name = messages.StringField(1),
+    history_length = messages.IntegerField(2, default = 5),)
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key = messages.StringField(1),)
+POLL_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key = messages.StringField(1),
+    version = messages.IntegerField(2, required = True),)
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key = messages.StringField(1),
+    since = messages.IntegerField(2, default = 0),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key = messages.StringField(1),)
 
 HIGH_SCORES_REQUEST = endpoints.ResourceContainer(
     number_of_results = messages.IntegerField(1),)
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    period = messages.StringField(1),
+    date = messages.StringField(2),
+    number_of_results = messages.IntegerField(3),)
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+# Rate limits as (calls per second, calls allowed in a row), per User for new Games and per Game
+# for moves, so scripted clients are turned away before any Datastore work is done
+NEW_GAME_RATE_LIMIT = (0.2, 5)
+MAKE_MOVE_RATE_LIMIT = (2, 10)
 
 
 @endpoints.api(name = 'hangman', version = 'v1')
@@ -76,7 +99,41 @@ class HangmanAPI(remote.Service):
             if not user:
                 raise endpoints.NotFoundException('A User with that name does not exist!')
 
-            return GameForms(items = [game.to_form() for game in user.get_games()])
+            return GameForms(items = [
+                game.to_form(user_name = user.name) for game in user.get_games()])
+
+
+        @endpoints.method(request_message = DASHBOARD_REQUEST,
+            response_message = DashboardForm,
+            path = 'user/{user_name}/dashboard',
+            name = 'get_user_dashboard',
+            http_method = 'GET')
+        def get_user_dashboard(self, request):
+            """Return the active Games, their recent history and the stats of the given User."""
+
+            user = User.query(User.name == request.user_name).get()
+
+            if not user:
+                raise endpoints.NotFoundException('A User with that name does not exist!')
+
+            # Find the active Games from the index, then fetch them and the stats in one batch
+            keys = Game.query(Game.game_over == False, ancestor = user.key).fetch(keys_only = True)
+            entities = ndb.get_multi([UserStats.key_for(user.key)] + keys)
+            stats, games = entities[0] or UserStats(), entities[1:]
+
+            history_length = max(request.history_length, 0)
+            items = []
+
+            for game in games:
+                if not game:
+                    continue
+
+                items.append(DashboardGameForm(
+                    game = game.to_form(user_name = user.name),
+                    history = game.get_guess_history(max(len(game.guesses) - history_length, 0))))
+
+            return DashboardForm(user = user.to_form(), stats = stats.to_form(user.name),
+                games = items)
 
 
         @endpoints.method(response_message = UserForms,
@@ -86,9 +143,7 @@ class HangmanAPI(remote.Service):
         def get_user_rankings(self, request):
             """Return all Users ranked by their win percentage."""
 
-            # Update statistics for all Users
-            for user in User.query():
-                user.update_stats()
+            # Statistics are kept up to date by the aggregation pipeline in main.py
 
             # Generate the list of ranked Users, ranked from high to low win %
             # Ties broken by the average misses of the tied Users, lower wins
@@ -102,6 +157,7 @@ class HangmanAPI(remote.Service):
             path = 'game',
             name = 'new_game',
             http_method = 'POST')
+        @rate_limit('new_game', lambda request: request.user_name, *NEW_GAME_RATE_LIMIT)
         def new_game(self, request):
             """Create a new Game."""
 
@@ -112,11 +168,6 @@ class HangmanAPI(remote.Service):
 
             game = Game.new_game(user.key, request.attempts)
 
-            # Use a task queue to update the average attempts remaining.
-            # This operation is not needed to complete the creation of a new game
-            # so it is performed out of sequence.
-            taskqueue.add(url = '/tasks/cache_average_attempts')
-
             return game.to_form('Game created! Good luck!')
 
 
@@ -136,6 +187,32 @@ class HangmanAPI(remote.Service):
             return game.to_form()
 
 
+        @endpoints.method(request_message = POLL_GAME_REQUEST,
+            response_message = GamePollForm,
+            path = 'game/{urlsafe_game_key}/poll',
+            name = 'poll_game',
+            http_method = 'GET')
+        def poll_game(self, request):
+            """Return the Game specified by the provided key only if its version has changed."""
+
+            # If the cached version matches, the Game is unchanged and nothing else is read
+            if Game.get_cached_version(request.urlsafe_game_key) == request.version:
+                return GamePollForm(version = request.version, modified = False)
+
+            game = get_by_urlsafe(request.urlsafe_game_key, Game)
+
+            if not game:
+                raise endpoints.NotFoundException('A Game with that key does not exist!')
+
+            # The cached version may have been evicted, so compare against the stored Game
+            game.publish_version()
+
+            if game.version == request.version:
+                return GamePollForm(version = game.version, modified = False)
+
+            return GamePollForm(version = game.version, modified = True, game = game.to_form())
+
+
         @endpoints.method(request_message = GET_GAME_REQUEST,
             response_message = GameForm,
             path = 'game/{urlsafe_game_key}/cancel',
@@ -157,7 +234,7 @@ class HangmanAPI(remote.Service):
             return game.to_form('This Game is now cancelled!')
 
 
-        @endpoints.method(request_message = GET_GAME_REQUEST,
+        @endpoints.method(request_message = GAME_HISTORY_REQUEST,
             response_message = GuessForms,
             path = 'game/{urlsafe_game_key}/history',
             name = 'get_game_history',
@@ -170,7 +247,23 @@ class HangmanAPI(remote.Service):
             if not game:
                 raise endpoints.NotFoundException('A Game with that key does not exist!')
 
-            return GuessForms(items = game.get_guesses())
+            return GuessForms(items = game.get_guesses(max(request.since, 0)))
+
+
+        @endpoints.method(request_message = GAME_HISTORY_REQUEST,
+            response_message = GuessHistoryForm,
+            path = 'game/{urlsafe_game_key}/history/compact',
+            name = 'get_game_history_compact',
+            http_method = 'GET')
+        def get_game_history_compact(self, request):
+            """Return the compact history for the Game specified by the provided key."""
+
+            game = get_by_urlsafe(request.urlsafe_game_key, Game)
+
+            if not game:
+                raise endpoints.NotFoundException('A Game with that key does not exist!')
+
+            return game.get_guess_history(max(request.since, 0))
 
 
         @endpoints.method(request_message = MAKE_MOVE_REQUEST,
@@ -178,6 +271,7 @@ class HangmanAPI(remote.Service):
             path = 'game/{urlsafe_game_key}',
             name = 'make_move',
             http_method = 'PUT')
+        @rate_limit('make_move', lambda request: request.urlsafe_game_key, *MAKE_MOVE_RATE_LIMIT)
         def make_move(self, request):
             """Make a move in the Game specified by the provided key."""
 
@@ -217,6 +311,35 @@ class HangmanAPI(remote.Service):
             return ScoreForms(items = [score.to_form() for score in scores])
 
 
+        @endpoints.method(request_message = LEADERBOARD_REQUEST,
+            response_message = ScoreForms,
+            path = 'scores/leaderboard/{period}',
+            name = 'get_leaderboard',
+            http_method = 'GET')
+        def get_leaderboard(self, request):
+            """Return the daily, weekly or monthly leaderboard containing the provided date."""
+
+            if request.period not in LEADERBOARD_RETENTION_DAYS:
+                raise endpoints.BadRequestException('Period must be one of: {}'.format(
+                    ', '.join(sorted(LEADERBOARD_RETENTION_DAYS))))
+
+            day = date.today()
+
+            if request.date:
+                try:
+                    day = datetime.strptime(request.date, '%Y-%m-%d').date()
+                except ValueError:
+                    raise endpoints.BadRequestException('Date must be formatted as YYYY-MM-DD')
+
+            # Each leaderboard is a single pre-aggregated entity
+            bucket = LeaderboardBucket.key_for(request.period, day).get()
+
+            if not bucket:
+                return ScoreForms(items = [])
+
+            return ScoreForms(items = bucket.to_forms(request.number_of_results))
+
+
         @endpoints.method(request_message = USER_REQUEST,
             response_message = ScoreForms,
             path = 'scores/user/{user_name}',
@@ -232,7 +355,26 @@ class HangmanAPI(remote.Service):
 
             scores = Score.query(Score.user == user.key)
 
-            return ScoreForms(items = [score.to_form() for score in scores])
+            return ScoreForms(items = [score.to_form(user.name) for score in scores])
+
+
+        @endpoints.method(request_message = USER_REQUEST,
+            response_message = UserStatsForm,
+            path = 'user/{user_name}/stats',
+            name = 'get_user_stats',
+            http_method = 'GET')
+        def get_user_stats(self, request):
+            """Return the precomputed stats for the given User."""
+
+            user = User.query(User.name == request.user_name).get()
+
+            if not user:
+                raise endpoints.NotFoundException('A User with that name does not exist!')
+
+            # A single entity read, maintained incrementally as each Game ends
+            stats = UserStats.key_for(user.key).get() or UserStats()
+
+            return stats.to_form(user.name)
 
 
         @endpoints.method(response_message = StringMessage,
@@ -242,22 +384,14 @@ class HangmanAPI(remote.Service):
         def get_average_attempts(self, request):
             """Get the cached average moves remaining."""
 
-            return StringMessage(message = memcache.get(MEMCACHE_MOVES_REMAINING) or '')
-
-
-        @staticmethod
-        def _cache_average_attempts():
-            """Populate memcache with the average moves remaining of all Games."""
+            message = memcache.get(MEMCACHE_MOVES_REMAINING)
 
-            games = Game.query(Game.game_over == False).fetch()
+            # Fall back to the average stored by the last aggregation run if it was evicted
+            if message is None:
+                message = moves_remaining_message(AggregationRun.get_moves_remaining())
+                memcache.set(MEMCACHE_MOVES_REMAINING, message)
 
-            if games:
-                count = len(games)
-                total_attempts_remaining = sum([game.attempts_remaining for game in games])
-                average = float(total_attempts_remaining) / count
-                memcache.set(
-                    MEMCACHE_MOVES_REMAINING,
-                    'The average moves remaining is {:.2f}'.format(average))
+            return StringMessage(message = message)
 
 
 api = endpoints.api_server([HangmanAPI])
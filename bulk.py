@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+bulk.py
+
+Converts User, Game and Score entities to and from plain dicts for the admin export and import
+handlers in main.py. Keys are written as flat paths rather than urlsafe strings, so an export can
+be imported into another application.
+"""
+
+from datetime import datetime
+from google.appengine.ext import ndb
+
+from models import User, Game, Score
+
+
+# The kinds that can be exported and imported, by name
+BULK_KINDS = {
+    'User': User,
+    'Game': Game,
+    'Score': Score,
+}
+
+# Pickled properties holding sets, which are written as sorted lists
+SET_PROPERTIES = ('guesses_set',)
+
+
+def entity_to_dict(entity):
+    """
+    Returns a JSON serializable dict of an entity's key and properties. Pickled properties such as
+    the Guess history of a Game are written out as the plain lists and dicts they hold.
+
+    Args:
+        entity: An entity of one of the BULK_KINDS
+    Returns:
+        A dict of the entity's properties, with its key path under 'key'
+    """
+
+    data = {'key': entity.key.flat()}
+
+    for name, prop in entity._properties.items():
+        value = getattr(entity, name)
+
+        if value is None:
+            pass
+        elif isinstance(prop, ndb.KeyProperty):
+            value = value.flat()
+        elif isinstance(prop, ndb.DateProperty):
+            value = value.isoformat()
+        elif name in SET_PROPERTIES:
+            value = sorted(value)
+
+        data[name] = value
+
+    return data
+
+
+def entity_from_dict(model, data):
+    """
+    Returns an unsaved entity built from a dict written by entity_to_dict.
+
+    Args:
+        model: The kind of entity to build, one of the BULK_KINDS
+        data: A dict as returned by entity_to_dict
+    Returns:
+        The entity, keyed as it was when it was exported
+    """
+
+    entity = model(key = ndb.Key(flat = data['key']))
+
+    for name, prop in model._properties.items():
+        value = data.get(name)
+
+        if value is None:
+            continue
+        elif isinstance(prop, ndb.KeyProperty):
+            value = ndb.Key(flat = value)
+        elif isinstance(prop, ndb.DateProperty):
+            value = datetime.strptime(value, '%Y-%m-%d').date()
+        elif name in SET_PROPERTIES:
+            value = set(value)
+
+        setattr(entity, name, value)
+
+    return entity
+
+
+def reserve_ids(entities):
+    """
+    Reserve the integer ids of stored entities, so ids allocated afterwards can't collide with
+    them. Without this the ids Game.new_game allocates under a User, and the ids given to new
+    Users and Scores, would start over and overwrite the imported entities.
+
+    Args:
+        entities: Entities that have been stored with the ids they were exported with
+    """
+
+    highest = {}
+
+    # Ids are allocated per kind and parent, so reserve up to the highest id of each
+    for entity in entities:
+        key = entity.key
+
+        if isinstance(key.id(), (int, long)):
+            group = (type(entity), key.parent())
+            highest[group] = max(highest.get(group, 0), key.id())
+
+    futures = [model.allocate_ids_async(max = max_id, parent = parent)
+        for (model, parent), max_id in highest.items()]
+
+    for future in futures:
+        future.get_result()
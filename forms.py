@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+forms.py
+
+Contains the protorpc message definitions used by the Hangman API.
+
+Kept apart from models.py so that handlers which only work with Datastore entities, such as
+those in main.py, do not load protorpc and every message class on import.
+"""
+
+from protorpc import messages
+
+
+# Definitions for the User ====================================================================== #
+
+class UserForm(messages.Message):
+    """Form for outbound User information"""
+
+    name = messages.StringField(1, required = True)
+    win_percentage = messages.FloatField(2, required = True)
+
+
+class UserForms(messages.Message):
+    """Return multiple UserForms"""
+
+    items = messages.MessageField(UserForm, 1, repeated = True)
+
+
+# Definitions for the UserStats ================================================================= #
+
+class DailyStatsForm(messages.Message):
+    """Form for outbound daily aggregate information"""
+
+    date = messages.StringField(1, required = True)
+    played = messages.IntegerField(2, required = True)
+    won = messages.IntegerField(3, required = True)
+    misses = messages.IntegerField(4, required = True)
+
+
+class UserStatsForm(messages.Message):
+    """Form for outbound UserStats information"""
+
+    user_name = messages.StringField(1, required = True)
+    games_played = messages.IntegerField(2, required = True)
+    wins = messages.IntegerField(3, required = True)
+    losses = messages.IntegerField(4, required = True)
+    cancels = messages.IntegerField(5, required = True)
+    win_percentage = messages.FloatField(6, required = True)
+    average_misses = messages.FloatField(7, required = True)
+    best_misses = messages.IntegerField(8)
+    median_misses = messages.FloatField(9)
+    current_streak = messages.IntegerField(10, required = True)
+    best_streak = messages.IntegerField(11, required = True)
+    miss_histogram = messages.IntegerField(12, repeated = True)
+    daily = messages.MessageField(DailyStatsForm, 13, repeated = True)
+
+
+# Definitions for the Guess ===================================================================== #
+
+class GuessForm(messages.Message):
+    """Form for outbound Guess information"""
+
+    guess = messages.StringField(1, required = True)
+    miss = messages.BooleanField(2, required = True)
+    message = messages.StringField(3, required = True)
+    state = messages.StringField(4, required = True)
+
+
+class GuessForms(messages.Message):
+    """Return multiple GuessForms"""
+
+    items = messages.MessageField(GuessForm, 1, repeated = True)
+
+
+class GuessHistoryForm(messages.Message):
+    """Form for outbound compact Guess history information"""
+
+    start = messages.IntegerField(1, required = True)
+    guesses = messages.StringField(2, repeated = True)
+    misses = messages.BooleanField(3, repeated = True)
+    state = messages.StringField(4, required = True)
+
+
+# Definitions for the Game ====================================================================== #
+
+class GameForm(messages.Message):
+    """Form for outbound Game information"""
+
+    urlsafe_key = messages.StringField(1, required = True)
+    user_name = messages.StringField(2, required = True)
+    public_word = messages.StringField(3, required = True)
+    attempts_remaining = messages.IntegerField(4, required = True)
+    game_over = messages.BooleanField(5, required = True)
+    cancelled = messages.BooleanField(6, required = True)
+    won = messages.BooleanField(7, required = True)
+    message = messages.StringField(8, required = True)
+    version = messages.IntegerField(9, required = True)
+
+
+class GameForms(messages.Message):
+    """Return multiple GameForms"""
+
+    items = messages.MessageField(GameForm, 1, repeated = True)
+
+
+class GamePollForm(messages.Message):
+    """Form for outbound Game changes, only carrying the Game if it has been modified"""
+
+    version = messages.IntegerField(1, required = True)
+    modified = messages.BooleanField(2, required = True)
+    game = messages.MessageField(GameForm, 3)
+
+
+class DashboardGameForm(messages.Message):
+    """Form for an outbound active Game with the tail of its history"""
+
+    game = messages.MessageField(GameForm, 1, required = True)
+    history = messages.MessageField(GuessHistoryForm, 2, required = True)
+
+
+class DashboardForm(messages.Message):
+    """Form for outbound dashboard information of a User"""
+
+    user = messages.MessageField(UserForm, 1, required = True)
+    stats = messages.MessageField(UserStatsForm, 2, required = True)
+    games = messages.MessageField(DashboardGameForm, 3, repeated = True)
+
+
+class NewGameForm(messages.Message):
+    """Form to create a new Game"""
+
+    user_name = messages.StringField(1, required = True)
+    attempts = messages.IntegerField(2, default = 6)
+
+
+class MakeMoveForm(messages.Message):
+    """Form to register a Guess in an existing Game"""
+
+    guess = messages.StringField(1, required = True)
+
+
+# Definitions for the Score ===================================================================== #
+
+class ScoreForm(messages.Message):
+    """Form for outbound Score information"""
+
+    user_name = messages.StringField(1, required = True)
+    date = messages.StringField(2, required = True)
+    won = messages.BooleanField(3, required = True)
+    misses = messages.IntegerField(4, required = True)
+
+
+class ScoreForms(messages.Message):
+    """Return multiple ScoreForms"""
+
+    items = messages.MessageField(ScoreForm, 1, repeated = True)
+
+
+# Miscellaneous Definitions ===================================================================== #
+
+class StringMessage(messages.Message):
+    """A single outbound StringMessage"""
+
+    message = messages.StringField(1, required = True)
@@ -4,14 +4,44 @@
 main.py
 
 This file contains handlers that are called by taskqueue and/or cronjobs.
+
+Modules only needed by a single handler are imported within that handler, so an instance
+started for one route does not pay for loading the others. In particular, api.py, which pulls
+in endpoints and every protorpc message on import, is only loaded by the warmup handler.
 """
 
+import importlib
+import json
 import logging
 import webapp2
 
-from api import HangmanAPI
-from google.appengine.api import mail, app_identity
-from models import User
+from datetime import date, datetime, timedelta
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from models import User, UserStats, Game, Score, AggregationRun
+from models import LeaderboardBucket, LEADERBOARD_RETENTION_DAYS, LEADERBOARD_SIZE
+from models import MEMCACHE_MOVES_REMAINING, RESULTS_QUEUE, moves_remaining_message
+
+
+# The number of entities read by each step of the stats aggregation pipeline
+AGGREGATION_BATCH_SIZE = 500
+
+# A run that has not checkpointed for this long is assumed to have stalled and is resumed
+AGGREGATION_STALL_TIMEOUT = timedelta(hours = 1)
+
+# The number of Game results leased per batch, and the number of batches per worker run
+RESULTS_BATCH_SIZE = 500
+RESULTS_MAX_BATCHES = 20
+
+# How long leased Game results are held before being handed out again, in seconds
+RESULTS_LEASE_SECONDS = 120
+
+# The number of entities read or written at a time by the admin export and import handlers
+BULK_BATCH_SIZE = 500
+
+# An export stops adding batches once its response reaches this size, in bytes
+EXPORT_MAX_BYTES = 16 * 1024 * 1024
 
 
 class SendReminderEmail(webapp2.RequestHandler):
@@ -19,6 +49,8 @@ class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
         """Send a reminder email each hour to each User with active Games using a cron job."""
 
+        from google.appengine.api import mail, app_identity
+
         app_id = app_identity.get_application_id()
         users = User.query(User.email != None)
         address = 'noreply@{}.appspotmail.com'.format(app_id)
@@ -35,16 +67,454 @@ class SendReminderEmail(webapp2.RequestHandler):
             mail.send_mail(address, user.email, subject, body)
 
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+class Warmup(webapp2.RequestHandler):
+
+    def get(self):
+        """Load the API module while a new instance is warming up, before it receives traffic."""
+
+        importlib.import_module('api')
+
+        self.response.set_status(200)
+
+
+class ExpireLeaderboards(webapp2.RequestHandler):
+
+    def get(self):
+        """Delete leaderboard buckets that have fallen out of retention using a cron job."""
+
+        LeaderboardBucket.expire(date.today())
+
+
+# Admin export and import ====================================================================== #
+#
+# Entities are written as newline-delimited JSON, one entity per line. An export reads batches
+# until its response is large enough and returns the cursor to continue from in the X-Next-Cursor
+# header, so a kind of any size can be exported with a bounded number of entities in memory.
+
+class ExportEntities(webapp2.RequestHandler):
+
+    def get(self):
+        """Write the entities of a kind as newline-delimited JSON, starting from a cursor."""
+
+        from bulk import BULK_KINDS, entity_to_dict
+
+        model = BULK_KINDS.get(self.request.get('kind'))
+
+        if not model:
+            self.abort(400, 'Kind must be one of: {}'.format(', '.join(sorted(BULK_KINDS))))
+
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe = cursor) if cursor else None
+        written = 0
+        more = True
+
+        self.response.content_type = 'application/x-ndjson'
+
+        while more and written < EXPORT_MAX_BYTES:
+            entities, cursor, more = model.query().fetch_page(
+                BULK_BATCH_SIZE, start_cursor = cursor)
+
+            for entity in entities:
+                line = json.dumps(entity_to_dict(entity)) + '\n'
+                written += len(line)
+                self.response.write(line)
+
+        if more and cursor:
+            self.response.headers['X-Next-Cursor'] = cursor.urlsafe()
+
+
+class ImportEntities(webapp2.RequestHandler):
+
+    def post(self):
+        """Store the entities of a kind from a newline-delimited JSON request body."""
+
+        from bulk import BULK_KINDS, entity_from_dict
+
+        model = BULK_KINDS.get(self.request.get('kind'))
+
+        if not model:
+            self.abort(400, 'Kind must be one of: {}'.format(', '.join(sorted(BULK_KINDS))))
+
+        batch = []
+        count = 0
+
+        for line in self.request.body_file:
+            if not line.strip():
+                continue
+
+            batch.append(entity_from_dict(model, json.loads(line)))
+
+            if len(batch) >= BULK_BATCH_SIZE:
+                _import_batch(batch)
+                count += len(batch)
+                batch = []
+
+        _import_batch(batch)
+        count += len(batch)
+
+        self.response.content_type = 'text/plain'
+        self.response.write('Imported {} {} entities\n'.format(count, model.__name__))
+
+
+def _import_batch(batch):
+    """Store a batch of imported entities, reserve their ids and publish Game versions."""
+
+    from bulk import reserve_ids
+
+    if not batch:
+        return
+
+    ndb.put_multi(batch)
+    reserve_ids(batch)
+
+    # One memcache call for the batch, so polls don't see the version of a Game it replaced
+    if isinstance(batch[0], Game):
+        memcache.set_multi(dict(
+            (Game.version_cache_key(game.key.urlsafe()), game.version) for game in batch))
+
+
+# Results worker ================================================================================ #
+#
+# Ended Games buffer their results in the results pull queue instead of writing a Score and
+# updating stats on the final move. The worker drains the queue in batches, writing every Score in
+# one put_multi and updating each User's stats and each leaderboard bucket once per batch, so a
+# burst of ended Games does not turn into a burst of writes to the same entities.
+
+class DrainResults(webapp2.RequestHandler):
+
+    def get(self):
+        """Write the buffered results of ended Games in batches using a cron job."""
+
+        from google.appengine.api import taskqueue
+
+        queue = taskqueue.Queue(RESULTS_QUEUE)
+
+        for _ in range(RESULTS_MAX_BATCHES):
+            tasks = queue.lease_tasks(RESULTS_LEASE_SECONDS, RESULTS_BATCH_SIZE)
+
+            if not tasks:
+                break
+
+            _ingest_results([json.loads(task.payload) for task in tasks])
+            queue.delete_tasks(tasks)
+
+
+def _ingest_results(results):
+    """Write the Scores, UserStats and leaderboard entries for a batch of Game results."""
+
+    users = ndb.get_multi([ndb.Key(urlsafe = user) for user in set(r['user'] for r in results)])
+    names = dict((user.key.urlsafe(), user.name) for user in users if user)
+
+    scores = []
+    by_user = {}
+    by_date = {}
+
+    for result in results:
+        by_user.setdefault(result['user'], []).append(result)
+
+        # Don't track a Score unless a User wins
+        if not result['won'] or result['user'] not in names:
+            continue
+
+        day = datetime.strptime(result['date'], '%Y-%m-%d').date()
+
+        # Keyed by the Game, so a batch that is handed out again doesn't duplicate its Scores
+        scores.append(Score(
+            key = ndb.Key(Score, result['game']),
+            user = ndb.Key(urlsafe = result['user']),
+            date = day,
+            won = True,
+            misses = result['misses']))
+
+        by_date.setdefault(day, []).append(
+            (result['misses'], result['date'], names[result['user']], result['game']))
+
+    # One transaction per User, run concurrently alongside the Score writes
+    futures = ndb.put_multi_async(scores)
+    futures.extend(UserStats.record_games_async(ndb.Key(urlsafe = user), user_results)
+        for user, user_results in by_user.items())
+
+    for future in futures:
+        future.get_result()
+
+    # One transaction per date, covering that date's daily, weekly and monthly buckets
+    for day, entries in by_date.items():
+        LeaderboardBucket.record_scores(day, entries)
+
+
+# Stats aggregation pipeline ==================================================================== #
+#
+# Rebuilds all derived data from the Game and Score kinds: User win percentages and average
+# misses, UserStats totals, the average attempts remaining of active Games, and the leaderboard
+# buckets that are still within retention. Each step processes one cursor-driven batch and
+# checkpoints its progress in an AggregationRun before chaining the next step as a task.
+
+class StartStatsAggregation(webapp2.RequestHandler):
+
+    def get(self):
+        """Start a stats aggregation run, or resume a stalled one, using a cron job."""
+
+        run = AggregationRun.query(AggregationRun.complete == False).get()
+
+        if run:
+            # Leave a run that is still making progress alone
+            if datetime.now() - run.updated < AGGREGATION_STALL_TIMEOUT:
+                return
+
+            # Otherwise pick it back up from its last checkpoint
+            logging.warning(
+                'Resuming stalled aggregation run %s at step %s', run.key.id(), run.step)
+        else:
+            run = AggregationRun(stage = 'games', state = {
+                'today': date.today(),
+                'user': None,
+                'tally': None,
+                'active_games': 0,
+                'active_remaining': 0,
+                'buckets': {},
+            })
+
+        _checkpoint(run, run.step)
+
+
+class AggregateStats(webapp2.RequestHandler):
 
     def post(self):
-        """Update game listing announcement in memcache."""
+        """Process one batch of the stats aggregation pipeline and chain the next step."""
+
+        run = AggregationRun.get_by_id(int(self.request.get('run')))
+        step = int(self.request.get('step'))
+
+        # Ignore retries of a step that has already been checkpointed
+        if not run or run.complete or run.step != step:
+            return
+
+        AGGREGATION_STAGES[run.stage](run)
+        run.step += 1
+
+        _checkpoint(run, step)
+
+
+@ndb.transactional
+def _checkpoint(run, step):
+    """Store the progress of a run made from the given step and enqueue its next step."""
+
+    # A duplicate task may have already checkpointed this step, in which case it wins
+    stored = run.key.get() if run.key else None
+
+    if stored and stored.step != step:
+        return
+
+    run.put()
+
+    if not run.complete:
+        from google.appengine.api import taskqueue
+
+        taskqueue.add(
+            url = '/tasks/aggregate_stats',
+            params = {'run': run.key.id(), 'step': run.step},
+            transactional = True)
+
+
+def _new_tally():
+    """Return an empty tally of the Games belonging to a single User."""
+
+    return {
+        'games': 0,
+        'wins': 0,
+        'recorded_wins': 0,
+        'losses': 0,
+        'cancels': 0,
+        'misses': 0,
+        'finished_misses': 0,
+        'histogram': {},
+        'pending': [],
+    }
+
+
+def _count_result(tally, game):
+    """Add the result of a single ended Game to the UserStats totals of a User's tally."""
+
+    misses = game.attempts_allowed - game.attempts_remaining
+
+    if game.cancelled:
+        tally['cancels'] += 1
+    elif game.won:
+        tally['recorded_wins'] += 1
+        tally['finished_misses'] += misses
+        tally['histogram'][misses] = tally['histogram'].get(misses, 0) + 1
+    else:
+        tally['losses'] += 1
+        tally['finished_misses'] += misses
+
+
+def _tally_game(tally, game):
+    """Add a single Game to a User's tally."""
+
+    misses = game.attempts_allowed - game.attempts_remaining
+
+    # Every Game counts towards the User's win percentage and average misses
+    tally['games'] += 1
+    tally['wins'] += 1 if game.won else 0
+    tally['misses'] += misses
+
+    # Only ended Games whose results are recorded count towards the UserStats. The ids of the
+    # rest are kept, so they can be checked again when the tally is stored
+    if not game.game_over or game.result_recorded is False:
+        tally['pending'].append(game.key.id())
+        return
+
+    _count_result(tally, game)
+
+
+@ndb.transactional_tasklet
+def _store_tally_async(key, tally):
+    """
+    Write the stats of the User with the given Key from their tally. Games that were active or
+    waiting in the results queue when tallied are read again in the same transaction, and any the
+    results worker has recorded since are counted, so the rebuild never overwrites them.
+    """
+
+    pending = [ndb.Key(Game, game_id, parent = key) for game_id in tally['pending']]
+    user, stats, games = yield (
+        key.get_async(),
+        UserStats.key_for(key).get_async(),
+        ndb.get_multi_async(pending))
+
+    # Work on a copy, as the transaction may be retried
+    tally = dict(tally, histogram = dict(tally['histogram']))
+
+    for game in games:
+        if game and game.result_recorded:
+            _count_result(tally, game)
+
+    entities = []
+
+    if user:
+        user.set_stats(tally['games'], tally['wins'], tally['misses'])
+        entities.append(user)
+
+    stats = stats or UserStats(key = UserStats.key_for(key))
+    stats.rebuild(
+        tally['recorded_wins'], tally['losses'], tally['cancels'],
+        tally['finished_misses'], tally['histogram'])
+    entities.append(stats)
+
+    yield ndb.put_multi_async(entities)
+
+
+def _aggregate_games(run):
+    """Tally a batch of Games into per-User stats and the active Game averages."""
+
+    state = run.state
+    cursor = Cursor(urlsafe = run.cursor) if run.cursor else None
+
+    # Games are descendants of their User, so in key order each User's Games are contiguous
+    games, next_cursor, more = Game.query().order(Game.key).fetch_page(
+        AGGREGATION_BATCH_SIZE, start_cursor = cursor)
+
+    finished = []
+
+    for game in games:
+        user = game.key.parent()
+
+        # Moving on to the next User, so the previous User's tally is complete
+        if user != state['user']:
+            if state['user']:
+                finished.append((state['user'], state['tally']))
+
+            state['user'] = user
+            state['tally'] = _new_tally()
+
+        _tally_game(state['tally'], game)
+
+        if not game.game_over:
+            state['active_games'] += 1
+            state['active_remaining'] += game.attempts_remaining
+
+    if more and next_cursor:
+        run.cursor = next_cursor.urlsafe()
+    else:
+        if state['user']:
+            finished.append((state['user'], state['tally']))
+
+        state['user'] = None
+        state['tally'] = None
+
+        # Kept on the run as well, so the average survives the cached message being evicted
+        if state['active_games']:
+            run.moves_remaining = float(state['active_remaining']) / state['active_games']
+
+        memcache.set(MEMCACHE_MOVES_REMAINING, moves_remaining_message(run.moves_remaining))
+
+        run.stage = 'scores'
+        run.cursor = None
+
+    # One transaction per finished User, run concurrently. A User's tally is carried across
+    # batches in the run's state until all of their Games are read
+    futures = [_store_tally_async(user, tally) for user, tally in finished]
+
+    for future in futures:
+        future.get_result()
+
+
+def _aggregate_scores(run):
+    """Collect a batch of Scores into the leaderboard buckets that are still within retention."""
+
+    state = run.state
+    today = state['today']
+    buckets = state['buckets']
+    cursor = Cursor(urlsafe = run.cursor) if run.cursor else None
+
+    # Older Scores can't fall within any retained bucket
+    cutoff = today - timedelta(days = max(LEADERBOARD_RETENTION_DAYS.values()))
+    scores, next_cursor, more = Score.query(Score.date >= cutoff).order(Score.date).fetch_page(
+        AGGREGATION_BATCH_SIZE, start_cursor = cursor)
+
+    users = ndb.get_multi(list(set(score.user for score in scores)))
+    names = dict((user.key, user.name) for user in users if user)
+
+    for score in scores:
+        if score.user not in names:
+            continue
+
+        entry = (score.misses, score.date.isoformat(), names[score.user], score.key.id())
+
+        for period, days in LEADERBOARD_RETENTION_DAYS.items():
+            start = LeaderboardBucket.bucket_start(period, score.date)
+
+            if start >= today - timedelta(days = days):
+                buckets.setdefault((period, start), []).append(entry)
+
+    # Only the best entries of each bucket need to be carried to the next batch
+    for bucket in buckets:
+        buckets[bucket] = sorted(buckets[bucket])[:LEADERBOARD_SIZE]
+
+    if more and next_cursor:
+        run.cursor = next_cursor.urlsafe()
+        return
+
+    # One transaction per bucket, so entries the results worker adds meanwhile are kept
+    for (period, start), entries in buckets.items():
+        LeaderboardBucket.rebuild(period, start, entries)
+
+    run.cursor = None
+    run.complete = True
+
 
-        HangmanAPI._cache_average_attempts()
-        self.response.set_status(204)
+AGGREGATION_STAGES = {
+    'games': _aggregate_games,
+    'scores': _aggregate_scores,
+}
 
 
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/crons/expire_leaderboards', ExpireLeaderboards),
+    ('/crons/aggregate_stats', StartStatsAggregation),
+    ('/crons/drain_results', DrainResults),
+    ('/admin/export', ExportEntities),
+    ('/admin/import', ImportEntities),
+    ('/tasks/aggregate_stats', AggregateStats),
 ], debug = True)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+measure_startup.py
+
+Measures how long each WSGI entry point takes to import, as a stand-in for instance cold start.
+
+Each measurement imports the entry point module in a fresh interpreter with the App Engine SDK on
+the path, and reports the median import time and the number of modules that were loaded. The
+None placeholders Python 2 leaves in sys.modules for failed relative imports are not counted.
+
+    $ python measure_startup.py --sdk [path-to-google_appengine]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# The modules behind the WSGI applications routed to in app.yaml
+ENTRY_POINTS = ['api', 'main']
+
+# Run in a fresh interpreter for each measurement so nothing is already imported
+MEASURE_IMPORT = '''
+import json, sys, time
+sys.path.insert(0, {sdk!r})
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path.insert(0, {app!r})
+before = set(sys.modules)
+start = time.time()
+import {module}
+elapsed = time.time() - start
+loaded = [name for name in set(sys.modules) - before if sys.modules[name] is not None]
+print(json.dumps({{'seconds': elapsed, 'modules': len(loaded)}}))
+'''
+
+
+def measure(sdk, module):
+    """Return the import time in seconds and the number of modules loaded for one import."""
+
+    app = os.path.dirname(os.path.abspath(__file__))
+    code = MEASURE_IMPORT.format(sdk = sdk, app = app, module = module)
+    result = json.loads(subprocess.check_output([sys.executable, '-c', code]).splitlines()[-1])
+
+    return result['seconds'], result['modules']
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Measure the import time of each entry point.')
+    parser.add_argument('--sdk', required = True, help = 'Path to the App Engine SDK')
+    parser.add_argument('--runs', type = int, default = 10, help = 'Measurements per entry point')
+    args = parser.parse_args()
+
+    for module in ENTRY_POINTS:
+        runs = [measure(args.sdk, module) for _ in range(args.runs)]
+        times = sorted(seconds for seconds, modules in runs)
+
+        print('{:<6} median {:7.1f} ms   max {:7.1f} ms   {} modules loaded'.format(
+            module, times[len(times) // 2] * 1000, times[-1] * 1000, runs[-1][1]))
+
+
+if __name__ == '__main__':
+    main()
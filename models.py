@@ -4,11 +4,16 @@
 models.py
 
 Contains the class definitions for the Datastore entities used by Hangman.
+
+The protorpc forms returned by to_form methods live in forms.py and are imported where they are
+built, so loading the entities alone doesn't load protorpc.
 """
 
-from datetime import date
+import json
+
+from datetime import date, timedelta
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
-from protorpc import messages
 
 from words import get_word
 
@@ -27,31 +32,16 @@ class User(ndb.Model):
     win_percentage = ndb.FloatProperty(default = 0.0)
     average_misses = ndb.FloatProperty(default = 0.0)
 
-    def update_stats(self):
-        """Update win_percentage and average_misses."""
-
-        # Get all Games belonging to this User
-        games = Game.query(ancestor = self.key).fetch()
-
-        num_games = len(games)
+    def set_stats(self, num_games, wins, misses):
+        """Set win_percentage and average_misses from totals over all of this User's Games."""
 
         if num_games < 1:
             return
 
-        wins = 0
-        misses = 0
-
-        # Tally up the number of wins and misses
-        for game in games:
-            wins += 1 if game.won else 0
-            misses += game.attempts_allowed - game.attempts_remaining
-
         # Calculate the new statistics
         self.win_percentage = (float(wins) / float(num_games)) * 100
         self.average_misses = float(misses) / float(num_games)
 
-        self.put()
-
     def get_games(self):
         """Return a collection of all active Games belonging to this User."""
 
@@ -72,6 +62,8 @@ class User(ndb.Model):
     def to_form(self):
         """Return a UserForm representation of the User."""
 
+        from forms import UserForm
+
         form = UserForm()
         form.name = self.name
         form.win_percentage = self.win_percentage
@@ -79,38 +71,202 @@ class User(ndb.Model):
         return form
 
 
-class UserForm(messages.Message):
-    """Form for outbound User information"""
+# Definitions for the UserStats ================================================================= #
+
+# The number of most recent days kept in the daily aggregates of a UserStats entity
+DAILY_STATS_DAYS = 30
+
+
+class UserStats(ndb.Model):
+    """UserStats object"""
+
+    '''
+    A single per-User document that is updated incrementally each time a Game ends, so stats
+    pages can read one entity instead of scanning every Game or Score belonging to the User.
+
+    total_misses: The number of misses over all won and lost Games
+    miss_histogram: A mapping of misses to the number of won Games with that many misses
+    current_streak: The number of consecutive won Games up to the most recent Game
+    daily: A mapping of ISO dates to [played, won, misses] for the most recent days
+    '''
+    wins = ndb.IntegerProperty(default = 0)
+    losses = ndb.IntegerProperty(default = 0)
+    cancels = ndb.IntegerProperty(default = 0)
+    total_misses = ndb.IntegerProperty(default = 0)
+    best_misses = ndb.IntegerProperty()
+    miss_histogram = ndb.PickleProperty()
+    current_streak = ndb.IntegerProperty(default = 0)
+    best_streak = ndb.IntegerProperty(default = 0)
+    daily = ndb.PickleProperty()
+
+    @classmethod
+    def key_for(cls, user):
+        """Return the Key of the UserStats belonging to the provided User Key."""
+
+        # Stored as a descendant of the User so it shares the User's entity group
+        return ndb.Key(cls, 'stats', parent = user)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def record_games_async(cls, user, results):
+        """
+        Fold the results of ended Games, in the order they ended, into the stats of the provided
+        User Key. Each result is a dict as buffered by Game.record_result.
+
+        The Games are marked as recorded in the same transaction, as they share the User's entity
+        group, and results of Games that are already recorded are skipped. So a batch of results
+        that is handed out again by the results queue is only counted once.
+        """
+
+        key = cls.key_for(user)
+        game_keys = [ndb.Key(urlsafe = result['game']) for result in results]
+        stats, games = yield key.get_async(), ndb.get_multi_async(game_keys)
+        stats = stats or cls(key = key)
+
+        # Work on copies so a shared default value is never mutated in place
+        histogram = dict(stats.miss_histogram or {})
+        daily = dict(stats.daily or {})
+        recorded = []
+
+        for result, game in zip(results, games):
+            if not game or game.result_recorded or game.key.parent() != user:
+                continue
+
+            game.result_recorded = True
+            recorded.append(game)
+
+            won = result['won']
+            misses = result['misses']
+            cancelled = result['cancelled']
+
+            if cancelled:
+                stats.cancels += 1
+                stats.current_streak = 0
+            elif won:
+                stats.wins += 1
+                stats.total_misses += misses
+                histogram[misses] = histogram.get(misses, 0) + 1
+                stats.best_misses = misses if stats.best_misses is None else min(
+                    stats.best_misses, misses)
+                stats.current_streak += 1
+                stats.best_streak = max(stats.best_streak, stats.current_streak)
+            else:
+                stats.losses += 1
+                stats.total_misses += misses
+                stats.current_streak = 0
+
+            # Tally the day's aggregates as [played, won, misses]
+            played, wins, day_misses = daily.get(result['date'], [0, 0, 0])
+            daily[result['date']] = [
+                played + 1, wins + (1 if won else 0), day_misses + (0 if cancelled else misses)]
+
+        # Only keep the most recent days so the entity stays compact
+        for day in sorted(daily)[:-DAILY_STATS_DAYS]:
+            del daily[day]
+
+        if not recorded:
+            raise ndb.Return(stats)
+
+        stats.miss_histogram = histogram
+        stats.daily = daily
+        yield ndb.put_multi_async([stats] + recorded)
+
+        raise ndb.Return(stats)
 
-    name = messages.StringField(1, required = True)
-    win_percentage = messages.FloatField(2, required = True)
+    def rebuild(self, wins, losses, cancels, total_misses, histogram):
+        """Replace the totals of the UserStats. Streaks and daily aggregates are kept as is."""
 
+        self.wins = wins
+        self.losses = losses
+        self.cancels = cancels
+        self.total_misses = total_misses
+        self.miss_histogram = dict(histogram)
+        self.best_misses = min(histogram) if histogram else None
 
-class UserForms(messages.Message):
-    """Return multiple UserForms"""
+    @property
+    def games_played(self):
+        """The number of ended Games, including cancelled Games."""
 
-    items = messages.MessageField(UserForm, 1, repeated = True)
+        return self.wins + self.losses + self.cancels
 
+    @property
+    def win_percentage(self):
+        """The percentage of ended Games that were won."""
 
-# Definitions for the Guess ===================================================================== #
+        if self.games_played < 1:
+            return 0.0
 
-class GuessForm(messages.Message):
-    """Form for outbound Guess information"""
+        return (float(self.wins) / float(self.games_played)) * 100
 
-    guess = messages.StringField(1, required = True)
-    miss = messages.BooleanField(2, required = True)
-    message = messages.StringField(3, required = True)
-    state = messages.StringField(4, required = True)
+    @property
+    def average_misses(self):
+        """The average number of misses over all won and lost Games."""
 
+        finished = self.wins + self.losses
 
-class GuessForms(messages.Message):
-    """Return multiple GuessForms"""
+        if finished < 1:
+            return 0.0
 
-    items = messages.MessageField(GuessForm, 1, repeated = True)
+        return float(self.total_misses) / float(finished)
+
+    @property
+    def median_misses(self):
+        """The median number of misses over all won Games, read from the histogram."""
+
+        if self.wins < 1:
+            return None
+
+        # Walk the histogram in order until the middle of the distribution is reached
+        lower = upper = None
+        seen = 0
+
+        for misses in sorted(self.miss_histogram or {}):
+            seen += self.miss_histogram[misses]
+
+            if lower is None and seen >= (self.wins + 1) // 2:
+                lower = misses
+            if seen >= self.wins // 2 + 1:
+                upper = misses
+                break
+
+        return (lower + upper) / 2.0
+
+    def to_form(self, user_name):
+        """Return a UserStatsForm representation of the UserStats."""
+
+        from forms import UserStatsForm, DailyStatsForm
+
+        form = UserStatsForm()
+        form.user_name = user_name
+        form.games_played = self.games_played
+        form.wins = self.wins
+        form.losses = self.losses
+        form.cancels = self.cancels
+        form.win_percentage = self.win_percentage
+        form.average_misses = self.average_misses
+        form.best_misses = self.best_misses
+        form.median_misses = self.median_misses
+        form.current_streak = self.current_streak
+        form.best_streak = self.best_streak
+
+        # Expand the histogram into a list indexed by the number of misses
+        if self.miss_histogram:
+            form.miss_histogram = [
+                self.miss_histogram.get(misses, 0)
+                for misses in range(max(self.miss_histogram) + 1)]
+
+        form.daily = [DailyStatsForm(date = day, played = played, won = won, misses = misses)
+            for day, (played, won, misses) in sorted((self.daily or {}).items())]
+
+        return form
 
 
 # Definitions for the Game ====================================================================== #
 
+# The pull queue that buffers the results of ended Games for the results worker in main.py
+RESULTS_QUEUE = 'results'
+
+
 class Game(ndb.Model):
     """Game object"""
 
@@ -119,6 +275,10 @@ class Game(ndb.Model):
     public_word: The User's current knowledge of the word - eg. '__at'
     guesses: An array of Guesses to track each Guess the User makes
     guesses_set: A set for tracking unique Guesses for easy lookup
+    version: A counter bumped each time a Guess is made or the Game is cancelled
+    result_recorded: False until the results worker has put the result of the ended Game in the
+        UserStats of its User, so a result that is handed out again isn't counted twice. None
+        for Games that ended before results were buffered, which are already counted
     '''
     private_word = ndb.StringProperty(required = True)
     public_word = ndb.StringProperty(required = True)
@@ -130,6 +290,29 @@ class Game(ndb.Model):
     cancelled = ndb.BooleanProperty(required = True, default = False)
     won = ndb.BooleanProperty(required = True, default = False)
     user = ndb.KeyProperty(required = True, kind = 'User')
+    version = ndb.IntegerProperty(default = 0)
+    result_recorded = ndb.BooleanProperty()
+
+    @staticmethod
+    def version_cache_key(urlsafe):
+        """Return the memcache key holding the version of the Game with the given urlsafe key."""
+
+        return 'GAME_VERSION_{}'.format(urlsafe)
+
+    @classmethod
+    def get_cached_version(cls, urlsafe):
+        """Return the cached version of the Game with the given urlsafe key, or None."""
+
+        return memcache.get(cls.version_cache_key(urlsafe))
+
+    def publish_version(self):
+        """
+        Cache the version of the Game so watchers can poll it without a Datastore read. Called
+        after each put that changes the version, rather than from a put hook, so the results
+        worker and the admin import don't make a memcache call for every Game they store.
+        """
+
+        memcache.set(Game.version_cache_key(self.key.urlsafe()), self.version)
 
     @classmethod
     def new_game(cls, user, attempts = 6):
@@ -150,6 +333,7 @@ class Game(ndb.Model):
         game.cancelled = False
         game.won = False
         game.user = user
+        game.result_recorded = False
 
         # Get a unique id for this game
         game_id = Game.allocate_ids(size = 1, parent = user)[0]
@@ -157,6 +341,7 @@ class Game(ndb.Model):
         game.key = ndb.Key(Game, game_id, parent = user)
         # Store the new Game
         game.put()
+        game.publish_version()
 
         return game
 
@@ -245,7 +430,15 @@ class Game(ndb.Model):
 
         # Add the Guess to our list and save the Game
         self.guesses.append(guess_obj)
-        self.put()
+        self.version += 1
+
+        # An ended Game is stored together with its buffered result
+        if self.game_over:
+            self.record_result(won = self.won)
+        else:
+            self.put()
+
+        self.publish_version()
 
         return guess_obj['message']
 
@@ -254,35 +447,53 @@ class Game(ndb.Model):
 
         self.cancelled = True
         self.game_over = True
-        self.put()
+        self.result_recorded = False
+        self.version += 1
+        self.record_result(cancelled = True)
+        self.publish_version()
 
     def end_game(self, won = False):
-        """End the Game. Accepts a boolean parameter to mark a win or loss."""
+        """
+        End the Game. Accepts a boolean parameter to mark a win or loss. The Game is stored and
+        its result buffered by guess, once the final Guess has been added.
+        """
 
         self.game_over = True
         self.won = won
-        self.put()
+        self.result_recorded = False
+
+    @ndb.transactional
+    def record_result(self, won = False, cancelled = False):
+        """
+        Store the ended Game and buffer its result in the results pull queue. Both happen in one
+        transaction, so a Game can't be stored as over without its result. The Score and stats
+        are written in batches by the results worker in main.py.
+        """
+
+        result = {
+            'game': self.key.urlsafe(),
+            'user': self.user.urlsafe(),
+            'won': won,
+            'cancelled': cancelled,
+            'misses': self.attempts_allowed - self.attempts_remaining,
+            'date': date.today().isoformat(),
+        }
 
-        # Don't track a Score unless a User wins
-        if not self.won:
-            return
+        # Only needed once a Game ends, so not loaded with the rest of the module
+        from google.appengine.api import taskqueue
 
-        # A Score is simply the number of misses by the User. Lower is better
-        score = Score()
-        score.user = self.user
-        score.date = date.today()
-        score.won = won
-        score.misses = self.attempts_allowed - self.attempts_remaining
+        self.put()
+        taskqueue.Queue(RESULTS_QUEUE).add(
+            taskqueue.Task(payload = json.dumps(result), method = 'PULL'), transactional = True)
 
-        # Add the Game to the scoreboard
-        score.put()
+    def get_guesses(self, since = 0):
+        """Return a collection of the Guesses for this Game from the given index as GuessForms."""
 
-    def get_guesses(self):
-        """Return a collection of all Guesses for this Game as GameForm objects."""
+        from forms import GuessForm
 
         guess_collection = []
 
-        for guess in self.guesses:
+        for guess in self.guesses[since:]:
             # Create a new GuessForm representation of this Guess
             guessForm = GuessForm()
             guessForm.guess = guess['guess']
@@ -290,58 +501,45 @@ class Game(ndb.Model):
             guessForm.message = guess['message']
             guessForm.state = guess['state']
 
-            guess_collection.append(guess)
+            guess_collection.append(guessForm)
 
         return guess_collection
 
-    def to_form(self, message = ''):
-        """Return a GameForm representation of the Game."""
+    def get_guess_history(self, since = 0):
+        """Return a compact GuessHistoryForm of the Guesses for this Game from the given index."""
+
+        from forms import GuessHistoryForm
+
+        guesses = self.guesses[since:]
+
+        # Only the current state is sent, the state after each Guess can be rebuilt from it
+        form = GuessHistoryForm()
+        form.start = since
+        form.guesses = [guess['guess'] for guess in guesses]
+        form.misses = [guess['miss'] for guess in guesses]
+        form.state = self.public_word
+
+        return form
+
+    def to_form(self, message = '', user_name = None):
+        """Return a GameForm representation of the Game. Skips the User lookup if named."""
+
+        from forms import GameForm
 
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user.get().name
         form.public_word = self.public_word
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
         form.cancelled = self.cancelled
         form.won = self.won
         form.message = message
+        form.version = self.version
 
         return form
 
 
-class GameForm(messages.Message):
-    """Form for outbound Game information"""
-
-    urlsafe_key = messages.StringField(1, required = True)
-    user_name = messages.StringField(2, required = True)
-    public_word = messages.StringField(3, required = True)
-    attempts_remaining = messages.IntegerField(4, required = True)
-    game_over = messages.BooleanField(5, required = True)
-    cancelled = messages.BooleanField(6, required = True)
-    won = messages.BooleanField(7, required = True)
-    message = messages.StringField(8, required = True)
-
-
-class GameForms(messages.Message):
-    """Return multiple GameForms"""
-
-    items = messages.MessageField(GameForm, 1, repeated = True)
-
-
-class NewGameForm(messages.Message):
-    """Form to create a new Game"""
-
-    user_name = messages.StringField(1, required = True)
-    attempts = messages.IntegerField(2, default = 6)
-
-
-class MakeMoveForm(messages.Message):
-    """Form to register a Guess in an existing Game"""
-
-    guess = messages.StringField(1, required = True)
-
-
 # Definitions for the Score ===================================================================== #
 
 class Score(ndb.Model):
@@ -352,11 +550,13 @@ class Score(ndb.Model):
     won = ndb.BooleanProperty(required = True)
     misses = ndb.IntegerProperty(required = True)
 
-    def to_form(self):
-        """Return a ScoreForm representation of the Score."""
+    def to_form(self, user_name = None):
+        """Return a ScoreForm representation of the Score. Skips the User lookup if named."""
+
+        from forms import ScoreForm
 
         form = ScoreForm()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user.get().name
         form.date = str(self.date)
         form.won = self.won
         form.misses = self.misses
@@ -364,24 +564,164 @@ class Score(ndb.Model):
         return form
 
 
-class ScoreForm(messages.Message):
-    """Form for outbound Score information"""
+# Definitions for the LeaderboardBucket ========================================================= #
+
+# The periods covered by LeaderboardBuckets, mapped to the number of days each bucket is kept
+LEADERBOARD_RETENTION_DAYS = {
+    'daily': 14,
+    'weekly': 12 * 7,
+    'monthly': 365,
+}
+
+# The number of entries kept in each LeaderboardBucket
+LEADERBOARD_SIZE = 25
 
-    user_name = messages.StringField(1, required = True)
-    date = messages.StringField(2, required = True)
-    won = messages.BooleanField(3, required = True)
-    misses = messages.IntegerField(4, required = True)
 
+class LeaderboardBucket(ndb.Model):
+    """LeaderboardBucket object"""
 
-class ScoreForms(messages.Message):
-    """Return multiple ScoreForms"""
+    '''
+    period: One of the keys of LEADERBOARD_RETENTION_DAYS
+    start: The first date covered by this bucket
+    entries: The best Scores recorded in this bucket as (misses, date, user_name, score_id),
+        best first, where score_id is the id of the Score's Key
+    '''
+    period = ndb.StringProperty(required = True)
+    start = ndb.DateProperty(required = True)
+    entries = ndb.PickleProperty()
+
+    @staticmethod
+    def bucket_start(period, day):
+        """Return the first date of the bucket of the given period that contains the date."""
+
+        if period == 'daily':
+            return day
 
-    items = messages.MessageField(ScoreForm, 1, repeated = True)
+        # Weeks start on Monday
+        if period == 'weekly':
+            return day - timedelta(days = day.weekday())
+
+        return day.replace(day = 1)
+
+    @classmethod
+    def key_for(cls, period, day):
+        """Return the Key of the bucket of the given period that contains the date."""
+
+        return ndb.Key(cls, '{}-{}'.format(period, cls.bucket_start(period, day).isoformat()))
+
+    @classmethod
+    @ndb.transactional(xg = True)
+    def record_scores(cls, day, entries):
+        """
+        Add (misses, date, user_name, score_id) entries from a date to every bucket containing
+        it. Entries whose Score is already in a bucket are skipped, so a batch of results that is
+        handed out again isn't listed twice.
+        """
+
+        periods = sorted(LEADERBOARD_RETENTION_DAYS)
+        buckets = ndb.get_multi([cls.key_for(period, day) for period in periods])
+        changed = []
+
+        for period, bucket in zip(periods, buckets):
+            if not bucket:
+                bucket = cls(
+                    key = cls.key_for(period, day),
+                    period = period,
+                    start = cls.bucket_start(period, day))
+
+            present = set(entry[3] for entry in bucket.entries or [])
+            added = [entry for entry in entries if entry[3] not in present]
+
+            # Lower misses are better, ties go to the earlier date and then by user name
+            merged = sorted(list(bucket.entries or []) + added)[:LEADERBOARD_SIZE]
+
+            # Skip the write if none of the Scores make the cut of the bucket
+            if merged == list(bucket.entries or []):
+                continue
+
+            bucket.entries = merged
+            changed.append(bucket)
+
+        ndb.put_multi(changed)
+
+    @classmethod
+    @ndb.transactional
+    def rebuild(cls, period, start, entries):
+        """
+        Replace the entries of the bucket of the given period starting on the date with entries
+        rebuilt from the Scores. Entries recorded by the results worker while the Scores were
+        being read are kept, so the rebuild can't drop them.
+        """
+
+        key = cls.key_for(period, start)
+        bucket = key.get() or cls(key = key, period = period, start = start)
+
+        present = set(entry[3] for entry in entries)
+        kept = [entry for entry in bucket.entries or [] if entry[3] not in present]
+
+        bucket.entries = sorted(kept + list(entries))[:LEADERBOARD_SIZE]
+        bucket.put()
+
+    @classmethod
+    def expire(cls, today):
+        """Delete every bucket that has fallen outside the retention of its period."""
+
+        for period, days in LEADERBOARD_RETENTION_DAYS.items():
+            cutoff = today - timedelta(days = days)
+            keys = cls.query(cls.period == period, cls.start < cutoff).fetch(keys_only = True)
+            ndb.delete_multi(keys)
+
+    def to_forms(self, limit = None):
+        """Return the entries of this bucket as a list of ScoreForm objects."""
+
+        from forms import ScoreForm
+
+        return [ScoreForm(user_name = user_name, date = day, won = True, misses = misses)
+            for misses, day, user_name, score_id in (self.entries or [])[:limit]]
+
+
+# Definitions for the AggregationRun ============================================================ #
+
+class AggregationRun(ndb.Model):
+    """AggregationRun object"""
+
+    '''
+    Checkpoint of a run of the stats aggregation pipeline in main.py.
+
+    stage: The stage of the pipeline being worked through - eg. 'games'
+    cursor: The urlsafe Cursor to resume the current stage from
+    step: The number of batches processed so far, used to ignore retried tasks
+    state: The partial results carried between batches
+    moves_remaining: The average attempts remaining of active Games, once the Games are tallied
+    '''
+    stage = ndb.StringProperty(required = True)
+    cursor = ndb.StringProperty()
+    step = ndb.IntegerProperty(required = True, default = 0)
+    state = ndb.PickleProperty()
+    moves_remaining = ndb.FloatProperty()
+    complete = ndb.BooleanProperty(required = True, default = False)
+    started = ndb.DateTimeProperty(auto_now_add = True)
+    updated = ndb.DateTimeProperty(auto_now = True)
+
+    @classmethod
+    def get_moves_remaining(cls):
+        """Return the average moves remaining found by the latest complete run, or None."""
+
+        run = cls.query(cls.complete == True).order(-cls.updated).get()
+
+        return run.moves_remaining if run else None
 
 
 # Miscellaneous Definitions ===================================================================== #
 
-class StringMessage(messages.Message):
-    """A single outbound StringMessage"""
+MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+
+
+def moves_remaining_message(average):
+    """Return the message cached under MEMCACHE_MOVES_REMAINING for an average or None."""
+
+    if average is None:
+        return ''
+
+    return 'The average moves remaining is {:.2f}'.format(average)
 
-    message = messages.StringField(1, required = True)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+simulate.py
+
+Plays Hangman offline for capacity planning. Games are driven through the real Game.guess logic
+by a configurable player strategy, without touching the Datastore, across a pool of processes.
+Reports the win rate, the number of moves per Game (and so make_move requests per Game) and the
+CPU cost of each Guess.
+
+    $ python simulate.py --sdk [path-to-google_appengine] --games 1000000 --strategy solver
+
+Strategies:
+    random - Guesses unguessed letters at random
+    frequency - Guesses unguessed letters from most to least common in English
+    solver - Guesses the letter found in the most dictionary words that still fit what is known,
+        or the word itself once only one fits
+"""
+
+import argparse
+import multiprocessing
+import random
+import string
+import sys
+import time
+
+
+# Letters ordered from most to least common in English text
+LETTER_FREQUENCY = 'etaoinshrdlcumwfgypbvkjxqz'
+
+# The number of Games played by each task handed to the process pool
+GAMES_PER_CHUNK = 1000
+
+# Process CPU time, rather than wall time, so a busy machine doesn't inflate the cost of a Guess
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+# Set up in each process by _setup, once the App Engine SDK is importable
+SimulatedGame = None
+words = None
+
+
+def _setup(sdk, dictionary):
+    """Put the App Engine SDK on the path and load the Game logic and dictionary."""
+
+    global SimulatedGame, words
+
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+    import models
+    import words as words_module
+
+    class SimulatedGame(models.Game):
+        """A Game that is never stored, so the Game logic can be driven without the Datastore."""
+
+        def put(self, **ctx_options):
+            pass
+
+        def publish_version(self):
+            pass
+
+        def record_result(self, won = False, cancelled = False):
+            pass
+
+    words = words_module
+
+    # Swap in another dictionary, so its effect on Game length can be compared
+    if dictionary:
+        with open(dictionary) as f:
+            words.words = [line.strip().lower() for line in f if line.strip()]
+
+
+def guess_random(game, rng):
+    """Guess an unguessed letter at random."""
+
+    return rng.choice([ch for ch in string.ascii_lowercase if ch not in game.guesses_set])
+
+
+def guess_frequency(game, rng):
+    """Guess the most common unguessed letter."""
+
+    return next(ch for ch in LETTER_FREQUENCY if ch not in game.guesses_set)
+
+
+def guess_solver(game, rng):
+    """Guess the letter in the most candidate words, or the word once there is one candidate."""
+
+    guessed = set(ch for ch in game.guesses_set if len(ch) == 1)
+
+    def fits(word):
+        if len(word) != len(game.public_word) or word in game.guesses_set:
+            return False
+
+        # Blanks can only hide letters that haven't been guessed yet
+        for known, ch in zip(game.public_word, word):
+            if known == '_' and ch in guessed:
+                return False
+            if known != '_' and known != ch:
+                return False
+
+        return True
+
+    candidates = [word for word in words.words if fits(word)]
+
+    if len(candidates) == 1:
+        return candidates[0]
+
+    # Count the candidate words each unguessed letter appears in
+    counts = {}
+
+    for word in candidates:
+        for ch in set(word) - guessed:
+            counts[ch] = counts.get(ch, 0) + 1
+
+    if not counts:
+        return guess_frequency(game, rng)
+
+    return max(sorted(counts), key = lambda ch: counts[ch])
+
+
+STRATEGIES = {
+    'random': guess_random,
+    'frequency': guess_frequency,
+    'solver': guess_solver,
+}
+
+
+def play(args):
+    """Play a chunk of Games and return their aggregated results."""
+
+    strategy, attempts, count, seed = args
+    rng = random.Random(seed)
+    choose = STRATEGIES[strategy]
+
+    # words.get_word draws from the module level random
+    random.seed(seed)
+
+    results = {'games': 0, 'wins': 0, 'moves': {}, 'guesses': 0, 'cpu': 0.0}
+
+    for _ in range(count):
+        word = words.get_word()
+
+        game = SimulatedGame(
+            private_word = word,
+            public_word = '_' * len(word),
+            attempts_allowed = attempts,
+            attempts_remaining = attempts,
+            guesses = [],
+            guesses_set = set())
+
+        while not game.game_over:
+            guess = choose(game, rng)
+
+            start = cpu_time()
+            game.guess(guess)
+            results['cpu'] += cpu_time() - start
+
+        moves = len(game.guesses)
+
+        results['games'] += 1
+        results['wins'] += 1 if game.won else 0
+        results['moves'][moves] = results['moves'].get(moves, 0) + 1
+        results['guesses'] += moves
+
+    return results
+
+
+def percentile(histogram, total, fraction):
+    """Return the value at the given fraction of a histogram of value counts."""
+
+    seen = 0
+
+    for value in sorted(histogram):
+        seen += histogram[value]
+
+        if seen >= total * fraction:
+            return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Simulate Hangman games for capacity planning.')
+    parser.add_argument('--sdk', required = True, help = 'Path to the App Engine SDK')
+    parser.add_argument('--games', type = int, default = 100000, help = 'Number of Games to play')
+    parser.add_argument('--strategy', choices = sorted(STRATEGIES), default = 'frequency')
+    parser.add_argument('--attempts', type = int, default = 6, help = 'Attempts allowed per Game')
+    parser.add_argument('--processes', type = int, default = multiprocessing.cpu_count())
+    parser.add_argument('--dictionary', help = 'File of words to use instead of words.py')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    chunks = []
+
+    for index, start in enumerate(range(0, args.games, GAMES_PER_CHUNK)):
+        count = min(GAMES_PER_CHUNK, args.games - start)
+        chunks.append((args.strategy, args.attempts, count, args.seed + index))
+
+    pool = multiprocessing.Pool(
+        args.processes, initializer = _setup, initargs = (args.sdk, args.dictionary))
+    started = time.time()
+
+    totals = {'games': 0, 'wins': 0, 'moves': {}, 'guesses': 0, 'cpu': 0.0}
+
+    for results in pool.imap_unordered(play, chunks):
+        for key in ('games', 'wins', 'guesses', 'cpu'):
+            totals[key] += results[key]
+        for moves, count in results['moves'].items():
+            totals['moves'][moves] = totals['moves'].get(moves, 0) + count
+
+    pool.close()
+    pool.join()
+
+    games = totals['games']
+    average_moves = float(totals['guesses']) / games
+
+    print('Strategy:           {}'.format(args.strategy))
+    print('Games:              {} in {:.1f}s'.format(games, time.time() - started))
+    print('Win rate:           {:.2f}%'.format(float(totals['wins']) / games * 100))
+    print('Moves per Game:     {:.2f} average, {} median, {} p95, {} max'.format(
+        average_moves,
+        percentile(totals['moves'], games, 0.5),
+        percentile(totals['moves'], games, 0.95),
+        max(totals['moves'])))
+    print('Requests per Game:  {:.2f} (new_game and make_move)'.format(average_moves + 1))
+    print('CPU per Guess:      {:.1f} us'.format(totals['cpu'] / totals['guesses'] * 1000000))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,33 @@ File for collecting general utility functions.
 """
 
 import endpoints
+import functools
 import logging
+import threading
+import time
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 
+# The most token buckets kept in each instance before they are all dropped
+MAX_LOCAL_BUCKETS = 10000
+
+# The number of times a shared token bucket update is retried when it races another instance
+MAX_CAS_RETRIES = 3
+
+# Token buckets of this instance, checked before the shared buckets in memcache
+_local_buckets = {}
+_local_lock = threading.Lock()
+
+
+class TooManyRequestsException(endpoints.ForbiddenException):
+    """
+    Raised when a rate limited endpoint is called too often. Sent as a 403, since Cloud Endpoints
+    v1 can't send a 429 and turns any status it doesn't know into a 500.
+    """
+
+
 def get_by_urlsafe(urlsafe, model):
     """
     Returns an ndb.Model entity that the urlsafe key points to. Checks that the type of entity
@@ -46,3 +68,95 @@ def get_by_urlsafe(urlsafe, model):
         raise ValueError('Incorrect Kind')
 
     return entity
+
+
+def rate_limit(name, key, rate, burst):
+    """
+    Decorator for HangmanAPI methods that limits how often they can be called for the same key.
+    Each key gets a token bucket that holds up to burst tokens and refills at rate tokens per
+    second. A call takes a token, and is rejected before the method runs if there are none left.
+
+    Buckets are kept in memcache so they are shared between instances, with a copy in each
+    instance so a caller that has already used up its bucket is rejected without a memcache call.
+    If memcache can't be reached the call is allowed.
+
+    Args:
+        name: A name for the limit, kept separate from the buckets of other limits
+        key: A function returning the key to limit by from the request message
+        rate: The number of calls allowed per second once the burst is used up
+        burst: The number of calls allowed in a row
+    Raises:
+        TooManyRequestsException
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, request):
+            bucket = 'RATE_LIMIT_{}_{}'.format(name, key(request))
+
+            if not _take_token(bucket, rate, burst):
+                raise TooManyRequestsException('Too many requests! Please slow down.')
+
+            return method(self, request)
+
+        return wrapper
+
+    return decorator
+
+
+def _refill(tokens, updated, now, rate, burst):
+    """Return the tokens in a bucket after refilling it from when it was last updated."""
+
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def _take_token(bucket, rate, burst):
+    """Take a token from the named bucket, returning False if it is empty."""
+
+    now = time.time()
+
+    # Check this instance's copy of the bucket first, an empty one needs no memcache call
+    with _local_lock:
+        if len(_local_buckets) > MAX_LOCAL_BUCKETS:
+            _local_buckets.clear()
+
+        tokens, updated = _local_buckets.get(bucket, (burst, now))
+        tokens = _refill(tokens, updated, now, rate, burst)
+
+        if tokens < 1:
+            _local_buckets[bucket] = (tokens, now)
+            return False
+
+    # Then take the token from the shared bucket
+    client = memcache.Client()
+    expires = int(burst / rate) + 1
+
+    for _ in range(MAX_CAS_RETRIES):
+        shared = client.gets(bucket)
+
+        if shared is None:
+            allowed = True
+            tokens = burst - 1
+            stored = client.add(bucket, (tokens, now), time = expires)
+        else:
+            tokens = _refill(shared[0], shared[1], now, rate, burst)
+            allowed = tokens >= 1
+
+            # An empty bucket is left as it is
+            if allowed:
+                tokens -= 1
+                stored = client.cas(bucket, (tokens, now), time = expires)
+            else:
+                stored = True
+
+        if stored:
+            # Keep this instance's copy in step with the shared bucket
+            with _local_lock:
+                _local_buckets[bucket] = (tokens, now)
+
+            return allowed
+
+    # Allow the call rather than fail it if the shared bucket could not be updated
+    logging.warning('Could not update rate limit bucket %s', bucket)
+
+    return True